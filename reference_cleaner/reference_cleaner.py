@@ -1,13 +1,14 @@
-from enum import Enum
-import io
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import json
 import logging
-from typing import Dict, Iterator, List
-
-from wmeijer_utils.file import OpenMany
-from wmeijer_utils.collections.safe_dict import SafeDict
-from wmeijer_utils.file import iterate_through_files_in_nested_folders
-
+import os
+import pickle
+import re
+import sys
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -16,6 +17,72 @@ logger.setLevel(logging.INFO)
 
 _ARTICLE_TYPE_KEY = "__article_type"
 
+# Terms that are not capitalized in titles, unless they start a (sub)title.
+_UNCAPITALIZED_TERMS = frozenset(
+    {
+        "a",
+        "an",
+        "and",
+        "as",
+        "at",
+        "but",
+        "by",
+        "for",
+        "in",
+        "nor",
+        "of",
+        "on",
+        "or",
+        "the",
+        "to",
+        "up",
+    }
+)
+_SUBTITLE_ICONS = frozenset({":", "-"})
+_BRACKET_TABLE = str.maketrans("", "", "{}")
+
+# Parsed bibtex files are cached in a file per project in this folder, keyed by their
+# path, mtime, and size. Bump the version whenever the parsed output changes to
+# invalidate old caches.
+_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "reference_cleaner")
+_CACHE_VERSION = 5
+_CacheIndex = Dict[str, Tuple[Tuple[int, int], Dict[str, Dict[str, str]]]]
+
+# Matches the start of bibtex entries (e.g., ``@article{key,``), capturing the article
+# type, opening bracket, and key. The entry's end is found by balancing its brackets.
+_ENTRY_RE = re.compile(rb"(@\w+)\s*(\{)\s*([^,\s]+)\s*,")
+# Matches the fields in an entry's body; values are either bare (e.g., ``year = 2020``),
+# bracketed, or quoted, in which case only the opening bracket or quote is matched.
+_FIELD_RE = re.compile(rb'([\w-]+)\s*=\s*(\{|"|[^,\n]+)')
+_BRACKET_RE = re.compile(rb"[{}]")
+_QUOTE_RE = re.compile(rb'[{}"]')
+# Matches line breaks (and surrounding indentation) in multi-line field values.
+_LINE_BREAK_RE = re.compile(rb"\s*\n\s*")
+
+# Matches citation commands (e.g., ``\cite``, ``\Citet``, ``\citep[see][p.~3]``,
+# ``\nocite``, ``\textcite``) and captures their arguments. Only biblatex's multicite
+# commands (e.g., ``\cites(pre)(post){a}[p.~1]{b}``) take global notes and more than
+# one bracketed argument.
+_CITE_RE = re.compile(
+    rb"\\[a-zA-Z]*[cC]ite"
+    rb"(?:s(?:\s*\([^)]*\)){0,2}"
+    rb"((?:\s*\[[^\]]*\])*(?:\s*\{[^}]*\}(?:\s*\[[^\]]*\])*)+)"
+    rb"|[a-zA-Z*]*((?:\s*\[[^\]]*\])*\s*\{[^}]*\}))"
+)
+# Matches the bracketed arguments of a citation command, capturing their comma-separated keys.
+_CITE_KEYS_RE = re.compile(rb"\{([^}]*)\}")
+# Matches latex comments, which run from an unescaped ``%`` to the end of the line.
+_LATEX_COMMENT_RE = re.compile(rb"(?<!\\)%[^\n]*")
+
+# Files are only processed in worker processes if there's enough data to make up for
+# starting them (about 0.2s of work each); files are sent to the workers in chunks.
+_PARALLEL_MIN_BIBTEX_SIZE = 1 << 20
+_PARALLEL_MIN_LATEX_SIZE = 16 << 20
+_CHUNK_SIZE = 4
+
+# The encoded bibtex keys in worker processes that scan latex files.
+_worker_encoded_keys: Dict[bytes, str] = dict()
+
 
 def clean_references(
     project_dir: str,
@@ -23,13 +90,18 @@ def clean_references(
     output_file: str,
 ):
     # Identifies all latex and bibtex files.
-    files = list(iterate_through_files_in_nested_folders(project_dir, max_depth=10000))
-    bibtex_files = [file for file in files if file.endswith(".bib")]
-    latex_files = [file for file in files if file.endswith(".tex")]
+    bibtex_files = []
+    latex_files = []
+    for file in _iterate_files_with_extensions(project_dir, (".bib", ".tex")):
+        if file.endswith(".bib"):
+            bibtex_files.append(file)
+        else:
+            latex_files.append(file)
 
     # Load bibtex files.
     # Index all bibtex entries.
-    bibtex_entries = load_bibtex_entries(bibtex_files)
+    cache_file = _get_cache_file(project_dir)
+    bibtex_entries = load_bibtex_entries(bibtex_files, cache_file)
 
     # Load tex files.
     # Find bibtex references in files.
@@ -50,208 +122,379 @@ def clean_references(
     store_bibtex(output_file, bibtex_extract)
 
 
-def load_bibtex_entries(bibtex_files: Iterator[str]) -> Dict[str, Dict]:
+def _iterate_files_with_extensions(
+    base_folder: str, extensions: Tuple[str, ...]
+) -> Iterator[str]:
+    """Iterates through all files in the (nested) folders of the base folder that have one of the extensions."""
+    folders = [base_folder]
+    visited_folders = set()
+    while len(folders) > 0:
+        folder = folders.pop()
+        # Symlinked folders are followed, but each folder is visited once to avoid cycles.
+        real_folder = os.path.realpath(folder)
+        if real_folder in visited_folders:
+            continue
+        visited_folders.add(real_folder)
+        with os.scandir(folder) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir():
+                    folders.append(dir_entry.path)
+                elif dir_entry.name.endswith(extensions):
+                    yield dir_entry.path
+
+
+def load_bibtex_entries(
+    bibtex_files: Iterator[str], cache_file: Optional[str] = None
+) -> Dict[str, Dict]:
     all_entries = dict()
-    with OpenMany(bibtex_files, "r", encoding="utf-8") as bibtex_files:
-        for file in bibtex_files:
-            file_entries = _load_bibtex_entry(file)
-            new_entries = {
-                key: value
-                for key, value in file_entries.items()
-                if key not in all_entries
-            }
-            all_entries.update(new_entries)
+    bibtex_files = [os.path.abspath(bibtex_file) for bibtex_file in bibtex_files]
+
+    # Unchanged files are loaded from the cache; the others are parsed in parallel.
+    # Records of files that are no longer part of the project are dropped.
+    old_cache = _load_cache(cache_file) if cache_file is not None else dict()
+    cache = dict()
+    stamps = {bibtex_file: _get_stamp(bibtex_file) for bibtex_file in bibtex_files}
+    stale_files = []
+    for bibtex_file in bibtex_files:
+        cached = old_cache.get(bibtex_file)
+        if cached is not None and cached[0] == stamps[bibtex_file]:
+            logger.info(f'Using cached bibtex entries of "{bibtex_file}".')
+            cache[bibtex_file] = cached
+        else:
+            stale_files.append(bibtex_file)
+    stale_size = sum(stamps[bibtex_file][1] for bibtex_file in stale_files)
+    worker_count = _get_worker_count(stale_files, stale_size, _PARALLEL_MIN_BIBTEX_SIZE)
+    if worker_count <= 1:
+        for bibtex_file in stale_files:
+            cache[bibtex_file] = (stamps[bibtex_file], _load_bibtex_entry(bibtex_file))
+    else:
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            parsed_entries = executor.map(
+                _load_bibtex_entry, stale_files, chunksize=_CHUNK_SIZE
+            )
+            for bibtex_file, file_entries in zip(stale_files, parsed_entries):
+                cache[bibtex_file] = (stamps[bibtex_file], file_entries)
+    is_cache_modified = len(stale_files) > 0 or cache.keys() != old_cache.keys()
+    if cache_file is not None and is_cache_modified:
+        _store_cache(cache_file, cache)
+
+    for bibtex_file in bibtex_files:
+        # Entries of earlier files take precedence over duplicates in later ones.
+        file_entries = cache[bibtex_file][1]
+        for key, value in file_entries.items():
+            all_entries.setdefault(key, value)
+
+    # Field keys repeat across entries, so they are interned. This happens here, as
+    # strings aren't interned when they are unpickled from the workers or the cache.
+    all_entries = {
+        key: {sys.intern(field_key): value for field_key, value in entry.items()}
+        for key, entry in all_entries.items()
+    }
     logger.info(f"Loaded {len(all_entries)} bibtex entries.")
     return all_entries
 
 
-def _safe_strip_comma(entry: str) -> str:
-    if entry.endswith(","):
-        return entry[:-1]
-    return entry
+def _get_stamp(path: str) -> Tuple[int, int]:
+    """Returns the modification time and size of a file, which identify its version in the cache."""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _get_cache_file(project_dir: str) -> str:
+    """Returns the cache file of a project, which is named after the hash of its path."""
+    real_project_dir = os.path.realpath(project_dir)
+    project_hash = hashlib.sha1(real_project_dir.encode("utf-8")).hexdigest()
+    return os.path.join(_CACHE_DIR, f"{project_hash}.pkl")
+
+
+def _load_cache(cache_file: str) -> _CacheIndex:
+    """Loads the index of previously parsed bibtex files, if there is a valid one."""
+    try:
+        with open(cache_file, "rb") as file:
+            version, cache = pickle.load(file)
+    except (
+        OSError,
+        EOFError,
+        AttributeError,
+        ImportError,
+        IndexError,
+        KeyError,
+        MemoryError,
+        OverflowError,
+        TypeError,
+        ValueError,
+        pickle.UnpicklingError,
+    ):
+        return dict()
+    if version != _CACHE_VERSION or not isinstance(cache, dict):
+        return dict()
+    return cache
+
+
+def _store_cache(cache_file: str, cache: _CacheIndex):
+    """Writes the cache to a temporary file first, so that it is replaced atomically."""
+    temp_file = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        file_descriptor, temp_file = tempfile.mkstemp(
+            dir=os.path.dirname(cache_file), suffix=".tmp"
+        )
+        with os.fdopen(file_descriptor, "wb") as file:
+            pickle.dump((_CACHE_VERSION, cache), file)
+        os.replace(temp_file, cache_file)
+    except OSError as ex:
+        logger.warning(f'Could not write bibtex cache "{cache_file}": {ex}')
+        if temp_file is not None and os.path.exists(temp_file):
+            os.remove(temp_file)
 
 
 def format_title(title: str) -> str:
     """Formats the title to adhere with ICSE rules."""
-    # Constants.
-    UNCAPITALIZED_TERMS = (
-        "a",
-        "an",
-        "and",
-        "as",
-        "at",
-        "but",
-        "by",
-        "for",
-        "in",
-        "nor",
-        "of",
-        "on",
-        "or",
-        "the",
-        "to",
-        "up",
-    )
-    SUBTITLE_ICONS = (":", "-")
-
     # Function state.
-    formatted_title = ""
+    formatted_terms = []
     is_new_title = True
 
     # Cleans input.
-    title = title.replace("{", "").replace("}", "")
+    title = title.translate(_BRACKET_TABLE)
 
     # Updates each of the terms in the title.
     terms = title.split(" ")
     for term in terms:
         # Every term that is not ignored, or the start of a (sub)title, is capitalized.
-        if term not in UNCAPITALIZED_TERMS or is_new_title:
+        if term not in _UNCAPITALIZED_TERMS or is_new_title:
             term = term[0].upper() + term[1:]
 
         # In terms containing a hypen, only the first character is capitalized.
         parts = term.split("-")
-        new_term = parts[0]
+        new_parts = [parts[0]]
         for part in parts[1:]:
-            part = part[0].lower() + part[1:]
-            new_term = f"{new_term}-{part}"
+            new_parts.append(part[0].lower() + part[1:])
+        new_term = "-".join(new_parts)
 
         # Title is updated.
-        formatted_title = f"{formatted_title} {{{new_term}}}"
+        formatted_terms.append(f"{{{new_term}}}")
 
         # Check if a subtitle has started.
-        is_new_title = new_term[-1] in SUBTITLE_ICONS
-    formatted_title = f"{{{formatted_title[1:]}}}"
+        is_new_title = new_term[-1] in _SUBTITLE_ICONS
+    formatted_title = f"{{{' '.join(formatted_terms)}}}"
 
     return formatted_title
 
 
-def _load_bibtex_entry(bibtex_file: io.IOBase) -> Dict[str, Dict[str, str]]:
+def _load_bibtex_entry(bibtex_file: str) -> Dict[str, Dict[str, str]]:
     """Loads bibtex entries from a bibtex file."""
-    logger.info(f'Extracting bibtex entries from "{bibtex_file.name}".')
+    logger.info(f'Extracting bibtex entries from "{bibtex_file}".')
     entries = dict()
 
-    class ReadState(Enum):
-        ENTRY = 1
-        NOTHING = 0
-
-    state = ReadState.NOTHING
-
-    for line in bibtex_file:
-        # Searches for a new entry
-        if state == ReadState.NOTHING:
-            if line.startswith("@"):
-                state = ReadState.ENTRY
-                article_type, reference_key = line.split("{")
-                article_type = article_type.strip()
-                reference_key = _safe_strip_comma(reference_key.strip())
-                new_entry = dict()
-                new_entry[_ARTICLE_TYPE_KEY] = article_type
-
-        # Deals with entry lines.
-        elif state == ReadState.ENTRY:
-            line = line.strip()
-            # We assume the end bracket is ALWAYS on a new line.
-            if line == "}":
-                state = ReadState.NOTHING
-                entries[reference_key] = new_entry
-
-            # We assume '=' isn't used for any other purpose beyond URLs.
-            elif "=" in line:
-                split = line.split("=")
-                field_key = split[0]
-                value = "=".join(split[1:])
-                field_key = field_key.strip()
-                value = _safe_strip_comma(value.strip())
-                if field_key == "title":
-                    value = format_title(value)
-                new_entry[field_key] = value
-
-            # We assume we're still dealing with the previous entry.
-            else:
-                line = _safe_strip_comma(line)
-                old_entry = new_entry[field_key]
-                new_entry[field_key] = f"{old_entry} {line}"
+    data = _read_file(bibtex_file)
+    entry_position = 0
+    while (entry_match := _ENTRY_RE.search(data, entry_position)) is not None:
+        article_type, _, reference_key = entry_match.groups()
+        entry_end = _find_closing_bracket(data, entry_match.start(2))
+        if entry_end is None:
+            logger.warning(
+                f'Skipping unclosed entry "{reference_key.decode("utf-8")}" in "{bibtex_file}".'
+            )
+            entry_position = entry_match.end()
+            continue
+        body = data[entry_match.end() : entry_end - 1]
+        entry_position = entry_end
+
+        new_entry = dict()
+        new_entry[_ARTICLE_TYPE_KEY] = article_type.decode("utf-8")
+
+        position = 0
+        while (field_match := _FIELD_RE.search(body, position)) is not None:
+            field_key, value = field_match.groups()
+            position = field_match.end()
+            # Bracketed values can be nested arbitrarily deep, and quoted values can
+            # contain quotes within brackets (e.g., ``M{\"u}ller``).
+            if value == b"{":
+                position = _find_closing_bracket(body, field_match.start(2)) or len(
+                    body
+                )
+                value = body[field_match.start(2) : position]
+            elif value == b'"':
+                position = _find_closing_quote(body, field_match.start(2))
+                value = body[field_match.start(2) : position]
+            # Field keys are case-insensitive.
+            field_key = field_key.decode("utf-8").lower()
+            value = value.strip()
+            # Most values are single-line, in which case there is nothing to join.
+            if b"\n" in value:
+                value = _LINE_BREAK_RE.sub(b" ", value)
+            value = value.decode("utf-8")
+            if field_key == "title":
+                value = format_title(value)
+            new_entry[field_key] = value
+
+        entries[reference_key.decode("utf-8")] = new_entry
 
     return entries
 
 
+def _find_closing_bracket(data: bytes, start: int) -> Optional[int]:
+    """Returns the position after the bracket that closes the one at the start position, if it is closed."""
+    depth = 0
+    for bracket_match in _BRACKET_RE.finditer(data, start):
+        depth += 1 if bracket_match.group() == b"{" else -1
+        if depth == 0:
+            return bracket_match.end()
+    return None
+
+
+def _find_closing_quote(data: bytes, start: int) -> int:
+    """Returns the position after the quote that closes the one at the start position."""
+    depth = 0
+    for quote_match in _QUOTE_RE.finditer(data, start + 1):
+        token = quote_match.group()
+        if token == b"{":
+            depth += 1
+        elif token == b"}":
+            depth -= 1
+        elif depth == 0:
+            return quote_match.end()
+    return len(data)
+
+
 def find_bibtex_references_in_files(
     latex_files: Iterator[str], bibtex_entry_keys: List[str]
 ) -> Iterator[str]:
     """Filters out bibtex entries that are not referenced in the provided latex files."""
     references = set()
-    with OpenMany(latex_files, "r", encoding="utf-8") as latex_files:
-        for file in latex_files:
-            file_references = find_bibtex_references_in_file(file, bibtex_entry_keys)
-            references = references.union(file_references)
+    # Keys are encoded once, so the latex files can be scanned without decoding them.
+    encoded_keys = {key.encode("utf-8"): key for key in bibtex_entry_keys}
+    unreferenced_keys = set(encoded_keys.values())
+    latex_files = list(latex_files)
+    if len(unreferenced_keys) == 0:
+        return references
+
+    latex_size = sum(os.path.getsize(latex_file) for latex_file in latex_files)
+    worker_count = _get_worker_count(latex_files, latex_size, _PARALLEL_MIN_LATEX_SIZE)
+    executor = None
+    if worker_count <= 1:
+        all_file_references = (
+            find_bibtex_references_in_file(latex_file, encoded_keys)
+            for latex_file in latex_files
+        )
+    else:
+        # The keys are passed to each worker once, rather than with every file.
+        executor = ProcessPoolExecutor(
+            max_workers=worker_count,
+            initializer=_init_reference_worker,
+            initargs=(encoded_keys,),
+        )
+        all_file_references = executor.map(
+            _find_bibtex_references_in_worker, latex_files, chunksize=_CHUNK_SIZE
+        )
+
+    try:
+        for file_references in all_file_references:
+            references.update(file_references)
+            unreferenced_keys.difference_update(file_references)
+            # Once every entry is referenced, the remaining files can't add anything.
+            if len(unreferenced_keys) == 0:
+                logger.info(
+                    "All bibtex entries are referenced; skipping remaining files."
+                )
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
     logger.info(f"Extracted {len(references)} references.")
     return references
 
 
+def _get_worker_count(files: List[str], total_size: int, min_size: int) -> int:
+    """Returns how many worker processes should process the files; one means none are started."""
+    if total_size < min_size:
+        return 1
+    chunk_count = -(-len(files) // _CHUNK_SIZE)
+    return min(os.cpu_count() or 1, chunk_count)
+
+
+def _init_reference_worker(encoded_keys: Dict[bytes, str]):
+    global _worker_encoded_keys
+    _worker_encoded_keys = encoded_keys
+
+
+def _find_bibtex_references_in_worker(latex_file: str) -> Iterator[str]:
+    return find_bibtex_references_in_file(latex_file, _worker_encoded_keys)
+
+
 def find_bibtex_references_in_file(
-    latex_file: io.IOBase, bibtex_entry_keys: List[str]
+    latex_file: str, encoded_keys: Dict[bytes, str]
 ) -> Iterator[str]:
     """Finds all bibtex references in a latex file."""
-    logger.info(f'Extracting references from "{latex_file.name}".')
+    logger.info(f'Extracting references from "{latex_file}".')
     references = set()
-    for line in latex_file:
-        for key in bibtex_entry_keys:
-            if key in line:
-                references.add(key)
+    data = _read_file(latex_file)
+    for match in _CITE_RE.finditer(data):
+        arguments = _LATEX_COMMENT_RE.sub(b"", match.group(1) or match.group(2))
+        for keys in _CITE_KEYS_RE.findall(arguments):
+            for encoded_key in keys.split(b","):
+                key = encoded_keys.get(encoded_key.strip())
+                if key is not None:
+                    references.add(key)
     return references
 
 
+def _read_file(path: str) -> bytes:
+    """Reads a file into memory at once."""
+    with open(path, "rb") as file:
+        return file.read()
+
+
 def apply_whitelist(bibtex_entries: Dict[str, Dict[str, str]], whitelist_file: str):
     with open(whitelist_file, "r", encoding="utf-8") as whitelist_file:
-        whitelist = set([entry.strip() for entry in whitelist_file.readlines()])
+        whitelist = set(
+            [sys.intern(entry.strip().lower()) for entry in whitelist_file.readlines()]
+        )
 
     logger.info(f"{whitelist=}")
 
     if len(whitelist) == 0:
         return bibtex_entries
 
-    for key, entry in bibtex_entries.items():
-        extract = dict()
-        for field_key, value in entry.items():
-            field_key = field_key.lower()
-            if field_key in whitelist or field_key == _ARTICLE_TYPE_KEY:
-                extract[field_key] = value
-        bibtex_entries[key] = extract
-
-    return bibtex_entries
+    allowed_fields = whitelist | {_ARTICLE_TYPE_KEY}
+    return {
+        key: {
+            field_key: value
+            for field_key, value in entry.items()
+            if field_key in allowed_fields
+        }
+        for key, entry in bibtex_entries.items()
+    }
 
 
 def store_bibtex(output_file: str, bibtex_entries: Dict[str, Dict[str, str]]):
     print(f"Writing output to '{output_file}'.")
-    with open(output_file, "w+", encoding="utf-8") as output_file:
-        sorted_fields = sorted(bibtex_entries.keys())
-        for key in sorted_fields:
-            entry = bibtex_entries[key]
-            output = _build_bibtex_entry_from(key, entry)
-            output_file.write(output)
+    sorted_keys = sorted(bibtex_entries.keys())
+    output = [_build_bibtex_entry_from(key, bibtex_entries[key]) for key in sorted_keys]
+    with open(output_file, "w", encoding="utf-8", buffering=1 << 20) as output_file:
+        output_file.write("".join(output))
 
 
 def _build_bibtex_entry_from(key: str, entry: Dict[str, str]) -> str:
     article_type = entry[_ARTICLE_TYPE_KEY]
-    # NOTE: This has side effects.
-    del entry[_ARTICLE_TYPE_KEY]
 
-    output = f"{article_type}{{{key},"
+    lines = [f"{article_type}{{{key},"]
 
-    sorted_fields = sorted(entry.keys())
+    sorted_fields = sorted(
+        field_key for field_key in entry.keys() if field_key != _ARTICLE_TYPE_KEY
+    )
     for field_key in sorted_fields:
         value = entry[field_key]
-        output = f"{output}\n\t{field_key} = {value},"
+        lines.append(f"\t{field_key} = {value},")
 
-    output = f"{output}\n}}\n"
+    lines.append("}\n")
 
-    return output
+    return "\n".join(lines)
 
 
 def _count_fields(bibtex_entries: Dict[str, Dict[str, str]]):
-    field_count = SafeDict(0)
+    field_count = Counter()
     for entry in bibtex_entries.values():
-        for key in entry.keys():
-            field_count[key] += 1
-    del field_count[_ARTICLE_TYPE_KEY]
+        field_count.update(entry.keys())
+    field_count.pop(_ARTICLE_TYPE_KEY, None)
     logger.info(f"Bibtex field entries:\n{json.dumps(field_count, indent=2)}")
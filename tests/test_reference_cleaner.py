@@ -0,0 +1,326 @@
+import sys
+
+import reference_cleaner.reference_cleaner as rc
+
+
+def _load_bibtex(tmp_path, data: bytes):
+    bibtex_file = tmp_path / "refs.bib"
+    bibtex_file.write_bytes(data)
+    return rc._load_bibtex_entry(str(bibtex_file))
+
+
+def _find_references(tmp_path, text: str, keys):
+    latex_file = tmp_path / "main.tex"
+    latex_file.write_text(text, encoding="utf-8")
+    encoded_keys = {key.encode("utf-8"): key for key in keys}
+    return rc.find_bibtex_references_in_file(str(latex_file), encoded_keys)
+
+
+def test_load_bibtex_entry(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@article{smith2020,\n"
+        b"  author = {Smith, John and\n"
+        b"    Doe, Jane},\n"
+        b"  year = 2020,\n"
+        b'  journal = "J",\n'
+        b"  url = {https://x.org/?a=b&c=d},\n"
+        b"  bdsk-url-1 = {https://y.org},\n"
+        b"}\n"
+        b"\n"
+        b"@misc{doe2021,\n"
+        b"  Note = {n},\n"
+        b"}\n",
+    )
+
+    assert entries == {
+        "smith2020": {
+            rc._ARTICLE_TYPE_KEY: "@article",
+            "author": "{Smith, John and Doe, Jane}",
+            "year": "2020",
+            "journal": '"J"',
+            "url": "{https://x.org/?a=b&c=d}",
+            "bdsk-url-1": "{https://y.org}",
+        },
+        "doe2021": {rc._ARTICLE_TYPE_KEY: "@misc", "note": "{n}"},
+    }
+
+
+def test_load_bibtex_entry_crlf(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@book{knuth1984,\r\n  publisher = {AW},\r\n  year = 1984\r\n}\r\n",
+    )
+
+    assert entries == {
+        "knuth1984": {
+            rc._ARTICLE_TYPE_KEY: "@book",
+            "publisher": "{AW}",
+            "year": "1984",
+        }
+    }
+
+
+def test_load_bibtex_entry_nested_brackets(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@misc{key,\n"
+        b"  note = {a {b {c {d, e} f} g} h},\n"
+        b"  year = 2020,\n"
+        b"}\n",
+    )
+
+    assert entries["key"]["note"] == "{a {b {c {d, e} f} g} h}"
+    assert entries["key"]["year"] == "2020"
+
+
+def test_load_bibtex_entry_multi_line_title(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@misc{key,\n"
+        b"  title = {a study of {Project-Based}\n"
+        b"    learning: the case},\n"
+        b"}\n",
+    )
+
+    assert (
+        entries["key"]["title"]
+        == "{{A} {Study} {of} {Project-based} {Learning:} {The} {Case}}"
+    )
+
+
+def test_load_bibtex_entry_empty_file(tmp_path):
+    assert _load_bibtex(tmp_path, b"") == {}
+
+
+def test_find_bibtex_references_in_file(tmp_path):
+    references = _find_references(
+        tmp_path,
+        "As shown by \\cite{a, b} and \\citep[see][p.~3]{c}.\n"
+        "See \\textcite {d} and \\nocite{e}.\n"
+        "The key f is mentioned, but never cited.\n",
+        ["a", "b", "c", "d", "e", "f"],
+    )
+
+    assert references == {"a", "b", "c", "d", "e"}
+
+
+def test_find_bibtex_references_in_file_unknown_keys(tmp_path):
+    references = _find_references(tmp_path, "\\cite{a,unknown}", ["a"])
+
+    assert references == {"a"}
+
+
+def test_find_bibtex_references_in_file_capitalized_commands(tmp_path):
+    references = _find_references(
+        tmp_path,
+        "\\Citet{k} showed this, as did \\Cites{a}{b}.",
+        ["k", "a", "b", "c"],
+    )
+
+    assert references == {"k", "a", "b"}
+
+
+def test_find_bibtex_references_in_file_multicite(tmp_path):
+    references = _find_references(
+        tmp_path,
+        "\\cites[see]{a}[p.~1]{b} and \\parencites{c} {d}.\n"
+        "\\cite{e} {f} is not a multicite.\n",
+        ["a", "b", "c", "d", "e", "f"],
+    )
+
+    assert references == {"a", "b", "c", "d", "e"}
+
+
+def test_iterate_files_with_extensions_follows_symlinks(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    (shared / "refs.bib").write_text("")
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "main.tex").write_text("")
+    (project / "notes.txt").write_text("")
+    (project / "bib").symlink_to(shared, target_is_directory=True)
+    (shared / "cycle").symlink_to(project, target_is_directory=True)
+
+    files = rc._iterate_files_with_extensions(str(project), (".bib", ".tex"))
+
+    assert sorted(files) == [
+        str(project / "bib" / "refs.bib"),
+        str(project / "main.tex"),
+    ]
+
+
+def test_load_bibtex_entries_drops_removed_files_from_cache(tmp_path):
+    first_file = tmp_path / "first.bib"
+    first_file.write_bytes(b"@misc{a,\n  year = 2020,\n}\n")
+    second_file = tmp_path / "second.bib"
+    second_file.write_bytes(b"@misc{b,\n  year = 2021,\n}\n")
+    cache_file = str(tmp_path / "cache" / "index.pkl")
+
+    entries = rc.load_bibtex_entries([str(first_file), str(second_file)], cache_file)
+    assert entries.keys() == {"a", "b"}
+    assert rc._load_cache(cache_file).keys() == {str(first_file), str(second_file)}
+
+    second_file.unlink()
+    entries = rc.load_bibtex_entries([str(first_file)], cache_file)
+    assert entries.keys() == {"a"}
+    assert rc._load_cache(cache_file).keys() == {str(first_file)}
+
+
+def test_load_bibtex_entries_ignores_corrupted_cache(tmp_path):
+    bibtex_file = tmp_path / "refs.bib"
+    bibtex_file.write_bytes(b"@misc{a,\n  year = 2020,\n}\n")
+    cache_file = tmp_path / "index.pkl"
+    cache_file.write_bytes(b"\x80\x04corrupted")
+
+    entries = rc.load_bibtex_entries([str(bibtex_file)], str(cache_file))
+
+    assert entries.keys() == {"a"}
+    assert rc._load_cache(str(cache_file)).keys() == {str(bibtex_file)}
+
+
+def test_load_bibtex_entries_interns_field_keys(tmp_path):
+    bibtex_file = tmp_path / "refs.bib"
+    bibtex_file.write_bytes(b"@misc{a,\n  YEAR = 2020,\n}\n")
+    cache_file = str(tmp_path / "index.pkl")
+
+    # The first load parses the file, the second one uses the cache.
+    for _ in range(2):
+        entries = rc.load_bibtex_entries([str(bibtex_file)], cache_file)
+        (field_key,) = [key for key in entries["a"] if key != rc._ARTICLE_TYPE_KEY]
+        assert field_key is sys.intern("year")
+
+
+def test_find_bibtex_references_in_files(tmp_path, monkeypatch):
+    latex_files = []
+    for index in range(10):
+        latex_file = tmp_path / f"{index}.tex"
+        latex_file.write_text(f"\\cite{{k{index}}}", encoding="utf-8")
+        latex_files.append(str(latex_file))
+    keys = [f"k{index}" for index in range(10)] + ["unused"]
+    expected_references = set(keys) - {"unused"}
+
+    # Small projects are scanned in this process.
+    assert rc.find_bibtex_references_in_files(latex_files, keys) == expected_references
+
+    monkeypatch.setattr(rc, "_PARALLEL_MIN_LATEX_SIZE", 0)
+    assert rc.find_bibtex_references_in_files(latex_files, keys) == expected_references
+
+
+def test_get_worker_count(monkeypatch):
+    monkeypatch.setattr(rc.os, "cpu_count", lambda: 8)
+    files = [f"{index}.tex" for index in range(10)]
+
+    assert rc._get_worker_count(files, total_size=10, min_size=100) == 1
+    assert rc._get_worker_count(files, total_size=100, min_size=100) == 3
+    assert rc._get_worker_count(files * 10, total_size=100, min_size=100) == 8
+
+
+def test_load_bibtex_entry_quoted_value_with_bracketed_quotes(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@misc{key,\n"
+        b'  author = "M{\\"u}ller, Hans and G{\\"o}del, Kurt",\n'
+        b"  year = 2020,\n"
+        b"}\n",
+    )
+
+    assert entries["key"]["author"] == '"M{\\"u}ller, Hans and G{\\"o}del, Kurt"'
+    assert entries["key"]["year"] == "2020"
+
+
+def test_load_bibtex_entry_closed_on_last_field_line(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@misc{a,\n  year = {2020}}\n"
+        b"@misc{b, note = {mail@example.org}, year = 2021}\n",
+    )
+
+    assert entries == {
+        "a": {rc._ARTICLE_TYPE_KEY: "@misc", "year": "{2020}"},
+        "b": {
+            rc._ARTICLE_TYPE_KEY: "@misc",
+            "note": "{mail@example.org}",
+            "year": "2021",
+        },
+    }
+
+
+def test_load_bibtex_entry_skips_unclosed_entry(tmp_path):
+    entries = _load_bibtex(
+        tmp_path,
+        b"@misc{bad,\n  note = {never closed,\n}\n\n@misc{good,\n  year = 2020,\n}\n",
+    )
+
+    assert entries == {"good": {rc._ARTICLE_TYPE_KEY: "@misc", "year": "2020"}}
+
+
+def test_find_bibtex_references_in_files_stops_when_all_keys_are_found(
+    tmp_path, monkeypatch
+):
+    latex_files = []
+    for index in range(4):
+        latex_file = tmp_path / f"{index}.tex"
+        latex_file.write_text(f"\\cite{{k{index}}}", encoding="utf-8")
+        latex_files.append(str(latex_file))
+    # These can't be read, so scanning them would fail.
+    for index in range(4, 12):
+        unreadable_file = tmp_path / f"{index}.tex"
+        unreadable_file.mkdir()
+        latex_files.append(str(unreadable_file))
+    keys = [f"k{index}" for index in range(4)]
+
+    assert rc.find_bibtex_references_in_files(latex_files, keys) == set(keys)
+
+    monkeypatch.setattr(rc, "_PARALLEL_MIN_LATEX_SIZE", 0)
+    assert rc.find_bibtex_references_in_files(latex_files, keys) == set(keys)
+
+
+def test_find_bibtex_references_in_file_multicite_global_notes(tmp_path):
+    references = _find_references(
+        tmp_path,
+        "\\cites(pre)(post)[a][b]{x}{y} and \\textcites(see){z}.",
+        ["x", "y", "z", "a", "b"],
+    )
+
+    assert references == {"x", "y", "z"}
+
+
+def test_find_bibtex_references_in_file_comments(tmp_path):
+    references = _find_references(
+        tmp_path,
+        "\\cite{a,% note about a\n b,\n % c,\n d}",
+        ["a", "b", "c", "d"],
+    )
+
+    assert references == {"a", "b", "d"}
+
+
+def test_load_bibtex_entries_reparses_changed_files(tmp_path, monkeypatch):
+    bibtex_file = tmp_path / "refs.bib"
+    bibtex_file.write_bytes(b"@misc{a,\n  year = 2020,\n}\n")
+    cache_file = str(tmp_path / "index.pkl")
+    rc.load_bibtex_entries([str(bibtex_file)], cache_file)
+
+    # Unchanged files are loaded from the cache.
+    parsed_files = []
+    load_bibtex_entry = rc._load_bibtex_entry
+
+    def _tracked_load_bibtex_entry(path):
+        parsed_files.append(path)
+        return load_bibtex_entry(path)
+
+    monkeypatch.setattr(rc, "_load_bibtex_entry", _tracked_load_bibtex_entry)
+    entries = rc.load_bibtex_entries([str(bibtex_file)], cache_file)
+    assert parsed_files == []
+    assert entries["a"]["year"] == "2020"
+
+    # Changed files are parsed again.
+    bibtex_file.write_bytes(
+        b"@misc{b,\n  year = 2021,\n}\n@misc{c,\n  year = 2022,\n}\n"
+    )
+    entries = rc.load_bibtex_entries([str(bibtex_file)], cache_file)
+    assert parsed_files == [str(bibtex_file)]
+    assert entries.keys() == {"b", "c"}
+    assert rc._load_cache(cache_file)[str(bibtex_file)][1].keys() == {"b", "c"}